@@ -9,6 +9,7 @@
 #
 # pip3 install faker
 # pip3 install jsonpath-ng
+# pip3 install ijson (optional, streams large top-level JSON arrays)
 
 import csv
 import json 
@@ -23,7 +24,17 @@ import jsonpath_ng.ext
 import time
 import ipaddress
 import random
+import re
 import traceback
+import multiprocessing
+import sys
+import codecs
+
+# Stream elements of top-level JSON arrays with ijson when available
+try:
+	import ijson
+except ImportError:
+	ijson = None
 
 VERSION = "1.04"
 TOOL_NAME = f"Anonym {VERSION}" 
@@ -31,11 +42,38 @@ TOOL_NAME = f"Anonym {VERSION}"
 args = None          # Parsed command line arguments
 handler_defs = []	 # Current handler definitions
 current_line = -1    # Current line in the CSV file
+base_seed = 0        # Seed for fake value generation
+parsed_paths = {}    # Parsed JSON paths by pattern
+
+IO_BUFFER_SIZE = 1 << 20  # Buffer size for input and output files
+
+# Well-formed addresses that can be handled without the ipaddress module
+IPV4_RE = re.compile(r"(?:0|[1-9][0-9]{0,2})(?:\.(?:0|[1-9][0-9]{0,2})){3}")
+IPV6_FULL_RE = re.compile(r"[0-9a-fA-F]{1,4}(?::[0-9a-fA-F]{1,4}){7}")
 
 fake = Faker()
 fake.add_provider(faker_commerce.Provider)
 fake.add_provider(internet)
 
+# Bind provider and random methods once to skip attribute lookups on every call
+_fake_name = fake.name
+_fake_email = fake.email
+_fake_uuid4 = fake.uuid4
+_fake_domain = fake.domain_name
+_fake_domain_word = fake.domain_word
+_fake_ipv4 = fake.ipv4_public
+_fake_ipv6 = fake.ipv6
+_fake_hostname = fake.hostname
+_fake_pyfloat = fake.pyfloat
+_fake_ecommerce_name = fake.ecommerce_name
+_fake_company = fake.company
+_fake_street_address = fake.street_address
+_fake_zipcode = fake.zipcode
+_fake_word = fake.word
+_random_range = random.randrange
+
+_MISS = object()     # Sentinel for cache misses
+
 def warning(msg, print_exception = False, field = None):
 	""" Print warning message. """
 	
@@ -59,20 +97,68 @@ def error(msg, print_exception = False, field = None):
 	
 	quit()
 
-def find_nth(str, sub, n):
-	""" Find n'th occurrence of the substring """
-	start = str.find(sub)
-	while start >= 0 and n > 1:
-		start = str.find(sub, start+len(sub))
-		n -= 1
-	return start
+def parse_path(pattern):
+	""" Parse JSON path, reusing the result for patterns that were already parsed """
+	path = parsed_paths.get(pattern)
+	if path == None:
+		path = jsonpath_ng.ext.parse(pattern)
+		parsed_paths[pattern] = path
+	return path
+
+def simple_path_keys(path):
+	""" Get the chain of keys for a plain 'a.b.c' JSON path, or None if the path is more complex """
+	keys = []
+	while isinstance(path, jsonpath_ng.jsonpath.Child):
+		if not isinstance(path.right, jsonpath_ng.jsonpath.Fields):
+			return None
+		keys.append(path.right)
+		path = path.left
+	if isinstance(path, jsonpath_ng.jsonpath.Fields):
+		keys.append(path)
+	elif not isinstance(path, jsonpath_ng.jsonpath.Root):
+		return None
+
+	# Only single, non-wildcard field names can be looked up directly
+	names = []
+	for f in reversed(keys):
+		if len(f.fields) != 1 or f.fields[0] == '*':
+			return None
+		names.append(f.fields[0])
+	return tuple(names) if names else None
+
+def is_all_elements(path):
+	""" Check if path selects all elements of the top-level array ('[*]' or '$[*]') """
+	if isinstance(path, jsonpath_ng.jsonpath.Child) and isinstance(path.left, jsonpath_ng.jsonpath.Root):
+		path = path.right
+	return isinstance(path, jsonpath_ng.jsonpath.Slice) and path.start == None and path.end == None and path.step == None
+
+def array_item_path(path):
+	""" Get the path relative to each top-level array element for '$[*].rest' paths, or None for other paths """
+	if not isinstance(path, jsonpath_ng.jsonpath.Child):
+		return None
+	if is_all_elements(path.left):
+		return path.right
+	rest = array_item_path(path.left)
+	if rest == None:
+		return None
+	return jsonpath_ng.jsonpath.Child(rest, path.right)
 	
 class Field:
 	""" Common supercalss for all field specifications """
 	cache = {}
+	needs_clean = False
+
+	def __init_subclass__(cls, **kwargs):
+		""" Give every field type its own cache of anonymized values """
+		super().__init_subclass__(**kwargs)
+		cls.cache = {}
+		# Only call clean() for field types that actually override it
+		cls.needs_clean = cls.clean is not Field.clean
 
 	def __init__(self, val):
 		self.field_spec = val
+		self.cache_get = self.cache.get
+		self.fast_anonymize = self.build_fast_anonymize()
 	
 		if args.type == 'csv':
 			# Split the field spec into a name and path for CSV fields
@@ -86,16 +172,29 @@ class Field:
 				self.name = val[:pos]
 				path = val[pos+1:]
 				try:
-					self.path = jsonpath_ng.ext.parse(path)
+					self.path = parse_path(path)
 				except:
 					error("Error parsing pattern: "+path, True)
 					
 		else:
 			self.name = None
 			try:
-				self.path = jsonpath_ng.ext.parse(val)
+				self.path = parse_path(val)
 			except:
 				error("Error parsing pattern: "+val, True)
+
+		# Plain key chains are traversed directly instead of through jsonpath
+		self.simple_keys = None
+		if self.path != None:
+			self.simple_keys = simple_path_keys(self.path)
+
+		# Paths into every element of a top-level array allow the array to be streamed
+		self.item_path = None
+		self.item_keys = None
+		if self.name == None and '..' not in self.field_spec:
+			self.item_path = array_item_path(self.path)
+			if self.item_path != None:
+				self.item_keys = simple_path_keys(self.item_path)
 			
 	def get_field_spec(self):
 		""" Get original field specification """
@@ -115,18 +214,29 @@ class Field:
 		
 	def anonymize(self, data):
 		""" Anonymize data and cache values """
-		data = self.clean(data)
-		
-		if data == None or data == "":
-			return data
-	
-		if data in self.cache.keys():
-			return self.cache[data]
-		else:
-			val = self.anonymize_data(data)
-			self.cache[data] = val
+		return self.fast_anonymize(data)
+
+	def build_fast_anonymize(self):
+		""" Build the anonymize() implementation with all lookups resolved up front """
+		cache = self.cache
+		cache_get = self.cache_get
+		anonymize_data = self.anonymize_data
+		# Only field types that override clean() pay for calling it
+		clean = self.clean if self.needs_clean else None
+
+		def fast_anonymize(data):
+			if clean is not None:
+				data = clean(data)
+			if data is None or data == "":
+				return data
+			val = cache_get(data, _MISS)
+			if val is _MISS:
+				val = anonymize_data(data)
+				cache[data] = val
 			return val
 
+		return fast_anonymize
+
 	def is_json_field(self):
 		""" Is it a JSON field? """
 		return self.path != None
@@ -136,10 +246,34 @@ class Field:
 		if '..' in self.field_spec:
 			# Handle recursive search
 			return self._recursive_find(val)
+		elif self.simple_keys != None:
+			# Direct lookup of a plain key chain
+			return self._simple_find(val, self.simple_keys)
 		else:
 			# Regular jsonpath search
 			return self.path.find(val)
 
+	def is_item_field(self):
+		""" Does the path apply to each element of a top-level array? """
+		return self.item_path != None
+
+	def matches_item(self, item):
+		""" Check if the path matches an element of the top-level array """
+		if self.item_keys != None:
+			return self._simple_find(item, self.item_keys)
+		return self.item_path.find(item)
+
+	def _simple_find(self, data, keys):
+		""" Find the element at a plain key chain by walking nested dicts """
+		parent = None
+		current = data
+		for key in keys:
+			if not isinstance(current, dict) or key not in current:
+				return []
+			parent = current
+			current = current[key]
+		return [JsonPathMatch(list(keys), current, parent)]
+
 	def _recursive_find(self, data):
 		""" Recursively find all matching elements in the JSON structure """
 		matches = []
@@ -152,7 +286,7 @@ class Field:
 				for key, value in obj.items():
 					if key == field_name:
 						# Create a custom match object similar to jsonpath
-						matches.append(JsonPathMatch(path + [key], value))
+						matches.append(JsonPathMatch(path + [key], value, obj))
 					if isinstance(value, (dict, list)):
 						_search_dict(value, path + [key])
 			elif isinstance(obj, list):
@@ -165,13 +299,19 @@ class Field:
 
 class JsonPathMatch:
 	""" Custom class to mimic jsonpath match objects """
-	def __init__(self, path, value):
+	def __init__(self, path, value, parent = None):
 		self.full_path = self
 		self.value = value
 		self._path = path
+		self._parent = parent
 	
 	def update(self, data, new_value):
 		""" Update the value at the specified path """
+		if self._parent != None:
+			# Write straight into the container found during the search
+			self._parent[self._path[-1]] = new_value
+			return data
+
 		current = data
 		for i, part in enumerate(self._path[:-1]):
 			if isinstance(current, dict):
@@ -185,10 +325,22 @@ class JsonPathMatch:
 			current[int(self._path[-1])] = new_value
 		return data
 
+def apply_updates(data, updates):
+	""" Write (match, new value) pairs back into the JSON document """
+	for match, new_value in updates:
+		path = match.path if isinstance(match, jsonpath_ng.DatumInContext) else None
+		if isinstance(path, jsonpath_ng.jsonpath.Fields) and len(path.fields) == 1 \
+				and match.context != None and isinstance(match.context.value, dict):
+			# Set the field on its parent object instead of re-walking the document from the root
+			match.context.value[path.fields[0]] = new_value
+		else:
+			data = match.full_path.update(data, new_value)
+	return data
+
 class NameField(Field):
 	""" Anonymize using 'FirstName LastName' """
 	def anonymize_data(self, data):
-		return fake.name()
+		return _fake_name()
 
 class EmailField(Field):
 	""" Anonymize e-mails """
@@ -205,34 +357,55 @@ class EmailField(Field):
 			if parts[1] in self.domains.keys():
 				dom = self.domains[parts[1]]
 			else:
-				dom = fake.domain_name()
+				dom = _fake_domain()
 				self.domains[parts[1]] = dom
-			return fake.email(domain = dom)
+			return _fake_email(domain = dom)
 		else:	
-			return fake.email(domain = "company.com")
+			return _fake_email(domain = "company.com")
 
 class IDField(Field):
 	""" Anonymize unique IDs """
 	def anonymize_data(self, data):
-		return fake.uuid4()
+		return _fake_uuid4()
 
 class HostField(Field):
 	""" Anonymize host names """
+	labels = {}          # (fake parent domain, fake label) pairs already in use
+	
 	def anonymize_data(self, data):
 		num_parts = data.count('.') + 1
 		if num_parts == 1:
-			return fake.hostname(0)
+			return _fake_hostname(0)
+		elif num_parts == 2:
+			return _fake_domain(1)
 		else:
-			return fake.domain_name(num_parts-1)
+			# Fake the leftmost label and the parent domain separately, making sure hosts in the same domain share the same fake domain
+			label = _fake_domain_word()
+			new_parent = self.anonymize(data.split('.', 1)[1])
+
+			# Make sure different hosts in the same domain do not end up with the same fake label
+			for _ in range(10):
+				if (new_parent, label) not in self.labels:
+					break
+				label = _fake_domain_word()
+			base_label = label
+			suffix = 2
+			while (new_parent, label) in self.labels:
+				label = base_label + str(suffix)
+				suffix += 1
+			self.labels[(new_parent, label)] = True
+			return label + "." + new_parent
 
 class IPField(Field):
 	""" Anonymize IPs """
 	
 	networks = {}
+	is_ipv4 = False      # Address kind detected by the last clean() call
 	
 	def clean(self, data):
 		""" Clean IPs to remove port numbers and other unneeded info """
-		if data.count('.') == 3:
+		self.is_ipv4 = data.count('.') == 3
+		if self.is_ipv4:
 			# IPv4
 			data = data.split(":")[0]
 		else:
@@ -243,23 +416,37 @@ class IPField(Field):
 				data = data[1:]
 		return data
 		
-	def gen_new_ip(self, ip, delim, occurrence, fake_ip):
+	def gen_new_ip(self, net, host, fake_net):
 		""" Generate new IP, making sure IPs from the same network (/24 for IPv4, /64 for IPv6) map to the same fake network """
-		pos = find_nth(ip, delim, occurrence)
-		net = ip[:pos]
-		host = ip[pos:]
-
-		if net in self.networks.keys():
-			new_net = self.networks[net]
-		else:
-			new_ip = fake_ip()
-			new_net = new_ip[:find_nth(new_ip, delim, occurrence)]
+		new_net = self.networks.get(net)
+		if new_net == None:
+			new_net = fake_net()
 			self.networks[net] = new_net
 		return new_net + host	
 
+	def normalize_ipv4(self, data):
+		""" Get the canonical form of an IPv4 address, raising ValueError if it is invalid """
+		if IPV4_RE.fullmatch(data):
+			for octet in data.split("."):
+				if int(octet) > 255:
+					break
+			else:
+				return data
+		return str(ipaddress.IPv4Address(data))
+
+	def explode_ipv6(self, data):
+		""" Get the exploded form of an IPv6 address, raising ValueError if it is invalid """
+		if IPV6_FULL_RE.fullmatch(data):
+			# All 8 groups are present, only need padding
+			return ":".join(group.zfill(4) for group in data.lower().split(":"))
+		if ":" not in data:
+			# Not an IPv6 address at all, no need for a full parse
+			raise ValueError("Not an IPv6 address: " + data)
+		return ipaddress.IPv6Address(data).exploded
+
 	def anonymize_data(self, data):
-		""" Anonymize IPs """
-		if data.count(".") == 3:
+		""" Anonymize IPs (relies on the address kind detected in clean()) """
+		if self.is_ipv4:
 			# IPv4
 
 			# CIDR handling
@@ -274,12 +461,14 @@ class IPField(Field):
 				except ValueError:
 					is_cidr = False
 			try:
-				ip = ipaddress.IPv4Address(data)
+				ip = self.normalize_ipv4(data)
 			except:
 				warning("Error parsing IP: "+data, True, self.get_field_spec())
 				return data
 
-			new_ip = self.gen_new_ip(str(ip), ".", 3, lambda: fake.ipv4_public())
+			# The /24 network is everything before the last dot
+			net, host = ip.rsplit(".", 1)
+			new_ip = self.gen_new_ip(net, "." + host, lambda: _fake_ipv4().rsplit(".", 1)[0])
 			if is_cidr:
 				return str(ipaddress.IPv4Network(new_ip + "/" + netmask, strict=False))
 			return new_ip
@@ -298,12 +487,13 @@ class IPField(Field):
 				except ValueError:
 					is_cidr = False
 			try:
-				ip = ipaddress.IPv6Address(data).exploded
+				ip = self.explode_ipv6(data)
 			except:
 				warning("Error parsing IP: "+data, True, self.get_field_spec())
 				return data
 
-			new_ip = self.gen_new_ip(ip, ":", 4, lambda: ipaddress.IPv6Address(fake.ipv6()).exploded)
+			# Exploded form has fixed-width groups, so the /64 network is always the first 19 characters
+			new_ip = self.gen_new_ip(ip[:19], ip[19:], lambda: ipaddress.IPv6Address(_fake_ipv6()).exploded[:19])
 			if is_cidr:
 				return str(ipaddress.IPv6Network(new_ip + "/" + netmask, strict=False))
 			return new_ip
@@ -327,42 +517,44 @@ class CoordField(Field):
 			return data
 
 		# We randomize with up to 0.5 degree difference (+/-50km)
-		val = "%.3f" % (float_val + (random.randrange(1000) - 500) * 0.001)
+		val = "%.3f" % (float_val + (_random_range(1000) - 500) * 0.001)
+		if self.type is str:
+			return val
 		return self.type(val)
 	
 class PriceField(Field):
 	def anonymize_data(self, data):
-		return fake.pyfloat(left_digits=3, right_digits=2, positive=True)
+		return _fake_pyfloat(left_digits=3, right_digits=2, positive=True)
 
 class ProductNameField(Field):
 	def anonymize_data(self, data):
-		return fake.ecommerce_name()
+		return _fake_ecommerce_name()
 
 class CompanyNameField(Field):
 	def anonymize_data(self, data):
-		return fake.company()
+		return _fake_company()
 
 class AddressField(Field):
 	def anonymize_data(self, data):
-		return fake.street_address()
+		return _fake_street_address()
 
 class AddressFieldZip(Field):
 	def anonymize_data(self, data):
-		return fake.zipcode()
+		return _fake_zipcode()
 	
 class HostnameField(Field):
 	def anonymize_data(self, data):
-		return fake.hostname()
+		return _fake_hostname()
 
 class WordField(Field):
 	def anonymize_data(self, data):
-		return fake.word()
+		return _fake_word()
 
 
 
 def parse_params():
 	""" Parse parameters. """
-	global args, handler_defs
+	global args, handler_defs, base_seed
 
 	
 	parser = argparse.ArgumentParser(description=TOOL_NAME+" - data anonymization tool")
@@ -384,10 +576,27 @@ def parse_params():
 	parser.add_argument("-t",  "--type", help="Type of input files; valid values - 'csv' (default), 'json'", type=str, default='csv', choices=['csv', 'json'])
 	parser.add_argument("-p",  "--predictable-names", help="Generate predictable artificial names (to use for regression testing)", action='store_true')
 	parser.add_argument("-o",  "--output-folder", help="Output folder to use", type=str, required=True)
+	parser.add_argument("-j",  "--jobs", help="Number of files to process in parallel (fake values are then only consistent within each file)", type=int, default=1)
 	parser.add_argument("-v",  "--verbose", help="Verbose output", action='store_true')
 
 	args = parser.parse_args() 
 
+	handler_defs.extend(create_handlers())
+
+	# Check output folder
+	if not os.path.isdir(args.output_folder):
+		error("Output folder does not exist: "+args.output_folder)
+	
+	# If requested (for testing), generate predictable fake values
+	base_seed = 0
+	if not args.predictable_names:
+		base_seed = time.time()
+	Faker.seed(base_seed)
+	random.seed(base_seed)
+
+def create_handlers():
+	""" Create handler objects for all field specs given on the command line """
+	handler_defs = []
 	handler_defs.extend(process_field_param(args.field_name,  NameField))
 	handler_defs.extend(process_field_param(args.field_email, EmailField))
 	handler_defs.extend(process_field_param(args.field_id,    IDField))
@@ -401,17 +610,7 @@ def parse_params():
 	handler_defs.extend(process_field_param(args.field_address_zip, AddressFieldZip))	
 	handler_defs.extend(process_field_param(args.field_hostname, HostField))	
 	handler_defs.extend(process_field_param(args.field_word, WordField))	
-
-	# Check output folder
-	if not os.path.isdir(args.output_folder):
-		error("Output folder does not exist: "+args.output_folder)
-	
-	# If requested (for testing), generate predictable fake values
-	seed = 0
-	if not args.predictable_names:
-		seed = time.time()
-	Faker.seed(seed)
-	random.seed(seed)
+	return handler_defs
 
 def process_field_param(value, cls):
 	""" Match field spec to a handler object """
@@ -422,105 +621,205 @@ def process_field_param(value, cls):
 	return handler_defs
 
 def process_headers(row):
-	""" Process header row """
+	""" Process header row, returning (column index, handlers) for the columns that have handlers """
 	global handler_defs
 
-	handlers = []
-	unused_handlers = handler_defs[:]
+	# Group handlers by the column name they refer to
+	handlers_by_name = {}
+	for handler in handler_defs:
+		handlers_by_name.setdefault(handler.get_name(), []).append(handler)
 
-	# Match handlers to columns
+	# Match handlers to columns, keeping only columns that need anonymization
+	handlers = []
 	for i in range(len(row)):
-		handlers.append([])
-		for handler in handler_defs:
-			if row[i] == handler.get_name():
-				handlers[i].append(handler)
-				
-				if handler in unused_handlers:
-					unused_handlers.remove(handler)
+		column_handlers = handlers_by_name.get(row[i])
+		if column_handlers:
+			handlers.append((i, column_handlers))
 	
 	# Check if there are any columns missing and alert
-	if len(unused_handlers) != 0:
-		names = []
-	
-		for handler in unused_handlers:
-			names.append(handler.get_name())
-		
+	columns = set(row)
+	names = [handler.get_name() for handler in handler_defs if handler.get_name() not in columns]
+	if len(names) != 0:
 		warning("Referenced header(s) not found: " + str(names))
 	
 	return handlers
 			
 	
-def anonymize_row(handlers, row):
+def build_plan(handlers):
+	""" Flatten active column handlers into (column, anonymize, is JSON, handler) entries for the row loop """
+	plan = []
+	for i, column_handlers in handlers:
+		for h in column_handlers:
+			plan.append((i, h.fast_anonymize, h.is_json_field(), h))
+	return plan
+
+def anonymize_row(plan, row):
 	""" Anonymize individual CSV row """
-	for i in range(len(row)):
-		for h in handlers[i]:
-			if h.is_json_field():
-				# Anonymize JSON in a CSV cell 
-				try:
-					cell = json.loads(row[i])
-					for match in h.matches(cell):
-						cell = match.full_path.update(cell, h.anonymize(match.value))
-					row[i] = json.dumps(cell)
-				except:
-					warning("Error parsing JSON: "+row[i], True, h.get_field_spec())
-			else:
-				row[i] = h.anonymize(row[i])
+	for i, anonymize, is_json, h in plan:
+		if i >= len(row):
+			continue
+		if is_json:
+			# Anonymize JSON in a CSV cell; only objects and arrays can contain matching fields
+			if row[i].lstrip()[:1] not in ("{", "["):
+				continue
+			try:
+				cell = json.loads(row[i])
+			except ValueError:
+				warning("Error parsing JSON: "+row[i], True, h.get_field_spec())
+				continue
+			try:
+				updates = [(match, anonymize(match.value)) for match in h.matches(cell)]
+				row[i] = json.dumps(apply_updates(cell, updates))
+			except Exception:
+				# Values the field cannot handle (e.g. null or nested objects) leave the cell unchanged
+				warning("Error anonymizing JSON: "+row[i], True, h.get_field_spec())
+		else:
+			row[i] = anonymize(row[i])
 	return row
 
-def process():
+def process_file(file):
+	""" Anonymize a single CSV or JSON file """
 	global current_line
 	
-	# Process files one by one
-	for file in args.files:
-		print("Processing " + file)
-		
-		try:
-			in_file = open(file, 'r', encoding='utf-8-sig') 
-		except:
-			error("Error opening input file: "+file, True)
-		
-		try:
-			out_file_name = os.path.join(args.output_folder, os.path.basename(file))
-			out_file = open(out_file_name, 'w', encoding='utf-8')
-		except:
-			error("Error opening output file: "+out_file_name, True)
-		
-		try:
-			# Process CSV
-			if args.type == 'csv':
-				csv_writer = csv.writer(out_file)
-				csv_reader = csv.reader(in_file)
-				headers = []
-				current_line = 1
-				for row in csv_reader:
-					# Assume first row is a header row
-					if current_line == 1:
-						csv_writer.writerow(row)
-						handlers = process_headers(row)
-					else:		
-						row = anonymize_row(handlers, row)
-						csv_writer.writerow(row)
-					
-					current_line += 1
-			# Process JSON
-			else:
+	try:
+		in_file = open(file, 'r', encoding='utf-8-sig', newline='', buffering=IO_BUFFER_SIZE)
+	except:
+		error("Error opening input file: "+file, True)
+	
+	try:
+		out_file_name = os.path.join(args.output_folder, os.path.basename(file))
+		out_file = open(out_file_name, 'w', encoding='utf-8', newline='', buffering=IO_BUFFER_SIZE)
+	except:
+		error("Error opening output file: "+out_file_name, True)
+	
+	try:
+		# Process CSV
+		if args.type == 'csv':
+			csv_writer = csv.writer(out_file)
+			csv_reader = csv.reader(in_file)
+			current_line = 1
+			# Assume first row is a header row
+			headers = next(csv_reader, None)
+			if headers != None:
+				csv_writer.writerow(headers)
+				plan = build_plan(process_headers(headers))
+				for current_line, row in enumerate(csv_reader, start=2):
+					csv_writer.writerow(anonymize_row(plan, row))
+		# Process JSON
+		else:
+			# The start of the document is kept rather than rewound, so input from pipes works too
+			head = read_json_start(in_file)
+
+			# Stream JSON arrays element by element when the only field applies to each element.
+			# With several fields, values are faked field by field over the whole document, and
+			# element by element processing would change the order (and so the -p output).
+			streamed = head.lstrip().startswith("[") and len(handler_defs) == 1 and handler_defs[0].is_item_field() \
+				and ijson != None and in_file.seekable() and stream_json_array(file, out_file)
+			if not streamed:
 				try:
-					data = json.load(in_file)
+					data = json.loads(head + in_file.read())
 				except:
 					error("Error parsing JSON file: "+file, True)
 				for h in handler_defs:
-					for match in h.matches(data):
-						data = match.full_path.update(data, h.anonymize(match.value))
+					updates = [(match, h.fast_anonymize(match.value)) for match in h.matches(data)]
+					data = apply_updates(data, updates)
 				out_file.write(json.dumps(data))
-		
-		# Exit without impediment when requested
-		except SystemExit:
-			pass
-		except Exception as e:
-			error("Error processing file:" + traceback.format_exc(), True)
-		finally:
-			out_file.close()
-			in_file.close()
+	
+	# Exit without impediment when requested
+	except SystemExit:
+		pass
+	except Exception as e:
+		error("Error processing file:" + traceback.format_exc(), True)
+	finally:
+		out_file.close()
+		in_file.close()
+
+def read_json_start(in_file):
+	""" Read the JSON document up to its first non-whitespace character, returning all text read """
+	head = ""
+	while True:
+		chunk = in_file.read(4096)
+		head += chunk
+		if chunk.strip() != "" or chunk == "":
+			return head
+
+def write_json_array(items, out_file):
+	""" Anonymize elements of a top-level JSON array and write them out as one array (same text as json.dumps()) """
+	out_file.write("[")
+	for i, item in enumerate(items):
+		for h in handler_defs:
+			updates = [(match, h.fast_anonymize(match.value)) for match in h.matches_item(item)]
+			item = apply_updates(item, updates)
+		# Same separators as json.dumps() uses for the whole array
+		if i > 0:
+			out_file.write(", ")
+		out_file.write(json.dumps(item))
+	out_file.write("]")
+
+def stream_json_array(file, out_file):
+	""" Stream a top-level JSON array with ijson. If ijson cannot read the data (e.g. integers wider
+	than 64 bits), undo all effects and return False so the file can be processed in memory. """
+	state = save_anonymization_state()
+	with open(file, 'rb', buffering=IO_BUFFER_SIZE) as bin_file:
+		if bin_file.read(len(codecs.BOM_UTF8)) != codecs.BOM_UTF8:
+			bin_file.seek(0)
+		try:
+			write_json_array(ijson.items(bin_file, 'item', use_float=True), out_file)
+			return True
+		except ijson.JSONError:
+			restore_anonymization_state(state)
+			out_file.seek(0)
+			out_file.truncate()
+			return False
+
+def save_anonymization_state():
+	""" Snapshot caches and random generators, so that fake values can be regenerated identically """
+	tables = [h.cache for h in handler_defs] + [EmailField.domains, IPField.networks, HostField.labels]
+	# Tables only grow and keep insertion order, so remembering their sizes is enough
+	sizes = {id(table): (table, len(table)) for table in tables}
+	return list(sizes.values()), random.getstate(), fake.random.getstate()
+
+def restore_anonymization_state(state):
+	""" Roll caches and random generators back to a snapshot """
+	tables, random_state, fake_state = state
+	# Drop entries added since the snapshot, newest first
+	for table, size in tables:
+		while len(table) > size:
+			table.popitem()
+	random.setstate(random_state)
+	fake.random.setstate(fake_state)
+
+def init_worker(worker_args):
+	""" Set up parameters and handlers in a worker process """
+	global args, handler_defs
+	args = worker_args
+	handler_defs = create_handlers()
+
+def process_file_job(file, seed):
+	""" Process a file in a worker process, seeding fake values per file """
+	Faker.seed(seed)
+	random.seed(seed)
+	try:
+		process_file(file)
+	except SystemExit:
+		# Errors are already reported, do not take the worker down
+		pass
+
+def process():
+	if args.jobs > 1 and len(args.files) > 1:
+		# Process files in parallel; every file gets a fresh worker so results do not depend on scheduling
+		jobs = [(file, base_seed + i) for i, file in enumerate(args.files)]
+		# Announce files up front so the progress output does not depend on scheduling either
+		for file in args.files:
+			print("Processing " + file)
+		sys.stdout.flush()
+		with multiprocessing.Pool(min(args.jobs, len(args.files)), init_worker, (args,), maxtasksperchild=1) as pool:
+			pool.starmap(process_file_job, jobs)
+	else:
+		# Process files one by one
+		for file in args.files:
+			print("Processing " + file)
+			process_file(file)
 		
 if __name__ == '__main__':
 	
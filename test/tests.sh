@@ -5,6 +5,8 @@
 OUT=./output
 rm -rf $OUT
 mkdir $OUT
+mkdir $OUT/parallel
+mkdir $OUT/stream
 
 # Run test and compare screen output to master
 test() {
@@ -30,11 +32,15 @@ test      "Help"                   "help"               "-h"
 test_file "Simple CSV"             "simple-csv"         "-p -o output -Fe email -Fn name -Fu id -Fi ip -Fh host -Fc long -Fc lat input/simple-csv.csv" "simple-csv.csv"
 test_file "Simple CSV 2 files"     "simple-csv-2"       "-p -o output -Fe email -Fn name -Fu id -Fi ip -Fh host -Fc long -Fc lat input/simple-csv.csv input/simple-csv-2.csv" "simple-csv.csv"
 diff ./master/simple-csv-2.csv $OUT/simple-csv-2.csv
+test_file "Parallel CSV 2 files"   "parallel-csv-2"     "-p -j 2 -o output/parallel -Fe email -Fn name -Fu id -Fi ip -Fh host -Fc long -Fc lat input/simple-csv.csv input/simple-csv-2.csv" "parallel/simple-csv.csv"
+diff ./master/parallel/simple-csv-2.csv $OUT/parallel/simple-csv-2.csv
 test      "Bad pattern"            "bad-pattern"        "-o output -Fn json.' input/csv-json.csv"
 test      "Bad pattern verbose"    "bad-pattern-verb"   "-v -o output -Fn json.' input/csv-json.csv"
 test      "Header not found"       "header-not-found"   "-o output -Fn badname1 -Fh badname2 input/csv-json.csv"
 test_file "CSV with JSON"          "csv-json"           "-p -o output -t csv -Fe json.a -Fu json.b -Fn json2.\$[?(@.a==\"1\")].b -Fh json2.\$[?(@.a==\"2\")].b input/csv-json.csv" "csv-json.csv"
 test_file "Simple JSON"            "simple-json"        "-p -o output -t json -Fn a.b -Fu x -Fh \$.array[?(@.a==\"1\")].b input/simple-json.json" "simple-json.json"
+test_file "CSV with JSON numbers"  "csv-json-numbers"   "-p -o output -Fn j.n input/csv-json-numbers.csv" "csv-json-numbers.csv"
+test_file "CSV with odd JSON values" "csv-json-odd"     "-p -o output -Fi ip.ip -Fn n.n input/csv-json-odd.csv" "csv-json-odd.csv"
 test      "Bad coord"              "bad-coord"          "-o output -Fc test input/bad-coord.csv"
 test      "Bad embedded JSON"      "bad-embed-json"     "-o output -Fu test.a input/bad-embed-json.csv"
 test      "Bad IPv4"               "bad-ipv4"           "-o output -Fi test input/bad-ipv4.csv"
@@ -45,5 +51,8 @@ test      "Missing output folder"  "missing-out-folder" "-o missing -Fi test inp
 test_file "Dirty IPs"              "dirty-ips"          "-p -o output -Fi ip input/dirty-ips.csv" "dirty-ips.csv"
 test_file "CIDR IPs"               "cidr-ips"           "-p -o output -Fi test input/cidr-ips.csv" "cidr-ips.csv"
 test_file "Host names"             "host-names"         "-p -o output -Fh test input/host-names.csv" "host-names.csv"
+test_file "JSON array"             "json-array"         "-p -o output -t json -Fn \$[*].name -Fe \$[*].email -Fi \$[*].net.ip input/json-array.json" "json-array.json"
+test_file "JSON array stream"      "json-array-stream"  "-p -o output -t json -Fn \$[*].name input/json-array-2.json" "json-array-2.json"
+test_file "JSON array fallback"    "json-array-fallback" "-p -o output/stream -t json -Fn \$[*].name input/json-array.json" "stream/json-array.json"
 
 